@@ -28,10 +28,15 @@ Extra features:
     - Define swath size
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import matplotlib.pyplot as plt
 from PIL import Image
-from scipy.signal import find_peaks
+from numba import njit
+
+from kernels import find_peaks_simple
 
 
 # ============User-defined parameters====================
@@ -52,33 +57,52 @@ swath_size = 10
 # =======================================================
 
 
+# count the peaks in swath lineouts start to stop, writing them into counts
+# releases the GIL so batches of swaths can be counted on separate threads
+@njit(cache=True, nogil=True)
+def count_swath_peaks(swaths, start, stop, min_h, min_d, counts):
+    for i in range(start, stop):
+        counts[i] = len(find_peaks_simple(swaths[i], min_h, min_d))
+
+
+# count the peaks in every swath lineout of an image
+def swath_peak_counts(image, size, min_h, min_d):
+    # compute every swath lineout at once from a running sum of the rows
+    cum = np.concatenate([np.zeros((1, image.shape[1])),
+                          image.cumsum(axis=0, dtype=np.float64)])
+    swaths = (cum[size:] - cum[:-size]) * (1.0/size)
+    # find peaks in each lineout with previously defined parameters,
+    # splitting the swaths into one batch per CPU
+    counts = np.empty(len(swaths), dtype=np.int64)
+    workers = os.cpu_count() or 1
+    edges = np.linspace(0, len(swaths), workers + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batches = [pool.submit(count_swath_peaks, swaths, edges[k], edges[k+1],
+                               min_h, min_d, counts)
+                   for k in range(workers)]
+        for batch in batches:
+            batch.result()
+    return counts
+
+
 # find the optimal swath lineout of an image
 def best_lineout(image, min_p, min_h, min_d):
-    # find all suitable lineouts
-    lineout_index = []
-    peaks_list = []
-    for i in range(len(image)-swath_size):
-        # find peaks in each lineout with previously defined parameters
-        swath = np.mean(img[i:i+swath_size], axis=0)
-        peaks, _ = find_peaks(swath, height=min_h, distance=min_d)
-        if len(peaks) > min_p*2:
-            lineout_index.append(i)
-            peaks_list.append(peaks)
+    # count peaks in each lineout with previously defined parameters
+    counts = swath_peak_counts(image, swath_size, min_h, min_d)
     # find optimal swath lineout (most peaks within criteria)
-    max_peaks = 0
-    best_swath = -1
-    for i in range(len(peaks_list)):
-        if len(peaks_list[i]) > max_peaks:
-            max_peaks = len(peaks_list[i])
-            best_swath = lineout_index[i]
+    best_swath = np.argmax(counts) if len(counts) else -1
     # return the starting index of the best swath lineout
     # if no suitable lineout found, return -1
+    if best_swath == -1 or counts[best_swath] <= min_p*2:
+        return -1
     return best_swath
 
 
 # import image data
 fimg = Image.open(filename)
 img = np.array(fimg)
+# convert once to contiguous float32 for all lineout calculations
+img = np.ascontiguousarray(img, dtype=np.float32)
 
 # minimum number of peaks needed based on user-defined parameters
 min_peaks = 2*num_peaks*every_n_peaks + skip_peaks_left + skip_peaks_right
@@ -87,7 +111,7 @@ min_peaks = 2*num_peaks*every_n_peaks + skip_peaks_left + skip_peaks_right
 swath_start = best_lineout(img, min_peaks, min_height, min_distance)
 # if none found, rotate image and try again
 if swath_start == -1:
-    img = np.rot90(img, axes=(1,0))
+    img = np.ascontiguousarray(np.rot90(img, axes=(1,0)))
     swath_start = best_lineout(img, min_peaks, min_height, min_distance)
 # if none found still, raise an exception
 if swath_start == -1:
@@ -97,41 +121,25 @@ if swath_start == -1:
 lineout = np.mean(img[swath_start:swath_start+swath_size], axis=0)
 
 # find peaks at best line with previously defined parameters
-peaks, _ = find_peaks(lineout, height=min_height, distance=min_distance)
-
+peaks = find_peaks_simple(lineout, min_height, min_distance)
+
+# find peaks counted on the left, from the first peak counted
+idx_left = skip_peaks_left + np.arange(num_peaks)*every_n_peaks
+# find peaks counted on the right, ending at the last peak counted
+idx_right = -1 - skip_peaks_right - np.arange(num_peaks)[::-1]*every_n_peaks
+# ensure enough peaks exist after skipping
+if idx_left[-1] >= len(peaks) or idx_right[0] < -len(peaks):
+    raise ValueError("Too many peaks skipped. Please redefine your parameters.")
 # keep track of peaks counted
-peaks_counted = []
+peaks_counted = np.concatenate([peaks[idx_left], peaks[idx_right]])
 
 # find spacing on left
-avg_space_left = 0
-for i in range(0, (num_peaks-1)*every_n_peaks, every_n_peaks):
-    # define starting point for counting peaks
-    st = i + skip_peaks_left
-    # ensure enough peaks exist after skipping
-    if st + every_n_peaks >= len(peaks):
-        raise ValueError("Too many peaks skipped. Please redefine your parameters.")
-    avg_space_left += peaks[st+every_n_peaks] - peaks[st]
-    # keep track of peaks counted
-    if i == 0:
-        peaks_counted.append(peaks[st])
-    peaks_counted.append(peaks[st+every_n_peaks])
-avg_space_left /= (num_peaks - 1)
+# (the spacings between counted peaks add up to the full span)
+avg_space_left = (peaks[idx_left[-1]] - peaks[idx_left[0]]) / (num_peaks - 1)
 print("Average space on left:", avg_space_left)
 
 # find spacing on right
-avg_space_right = 0
-for i in reversed(range(0, (num_peaks-1)*every_n_peaks, every_n_peaks)):
-    # define starting point for counting peaks
-    st = -i - skip_peaks_right - 1
-    # ensure enough peaks exist after skipping
-    if st - every_n_peaks < -len(peaks):
-        raise ValueError("Too many peaks skipped. Please redefine your parameters.")
-    avg_space_right += peaks[st] - peaks[st-every_n_peaks]
-    # keep track of peaks counted
-    peaks_counted.append(peaks[st-every_n_peaks])
-    if i == 0:
-        peaks_counted.append(peaks[st])
-avg_space_right /= (num_peaks - 1)
+avg_space_right = (peaks[idx_right[-1]] - peaks[idx_right[0]]) / (num_peaks - 1)
 print("Average space on right:", avg_space_right)
 
 # find difference in spacing
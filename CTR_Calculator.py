@@ -17,8 +17,9 @@ Extra features:
 import numpy as np
 import matplotlib.pyplot as plt
 from PIL import Image
-from scipy import stats
-from scipy.signal import find_peaks, argrelmin
+from numba import njit, prange
+
+from kernels import find_minima, find_wide_peaks
 
 
 # ============User-defined parameters====================
@@ -34,48 +35,118 @@ right_offset = 0
 # =======================================================
 
 
-# determine CTR throughout lineout
-def get_ctr(line):
-    # find peaks in the lineout
-    peaks, _ = find_peaks(line, width=3)
-    # find local minima in the lineout
-    mins = argrelmin(line)[0]
-    
-    # initialize arrays
-    ctr = np.array([])
-    non_zero = []
+# determine CTR throughout lineout, writing it into ctr
+@njit(cache=True, fastmath=True, nogil=True)
+def get_ctr(line, peaks, mins, background, stdev, ctr):
+    # clear the output row
+    ctr[:] = 0.0
+    # left and right limits of data (-1 if none found)
+    left = -1
+    right = -1
+    first_window = True
+    # window bounds into peaks and mins (exclusive on both sides)
+    peaks_lo = 0
+    peaks_hi = 0
+    mins_lo = 0
+    mins_hi = 0
     # determine CTR for each 40-pixel window across lineout
-    for i in range(20, len(line)-20):
-        window_peaks = line[peaks[np.logical_and(peaks > i-20, peaks < i+20)]]
+    for k in range(len(line)-40):
+        i = k + 20
+        # windows only move right, so advance the bounds in place
+        while peaks_lo < len(peaks) and peaks[peaks_lo] <= k:
+            peaks_lo += 1
+        while peaks_hi < len(peaks) and peaks[peaks_hi] < k + 40:
+            peaks_hi += 1
+        while mins_lo < len(mins) and mins[mins_lo] <= k:
+            mins_lo += 1
+        while mins_hi < len(mins) and mins[mins_hi] < k + 40:
+            mins_hi += 1
         # if no peaks in window, CTR is 0
-        if not len(window_peaks):
-            ctr = np.append(ctr, 0.0)
+        if peaks_lo >= peaks_hi:
             continue
         # find highest peak in 40-pixel swath
-        max_peak = max(window_peaks)
-        # if highest peak is not significant, CTR is 0
-        if max_peak < background + stdev:
-            ctr = np.append(ctr, 0.0)
-        else:
+        max_peak = line[peaks[peaks_lo]]
+        for j in range(peaks_lo + 1, peaks_hi):
+            max_peak = max(max_peak, line[peaks[j]])
+        # if highest peak is not significant or there are no minima, CTR is 0
+        if max_peak >= background + stdev and mins_lo < mins_hi:
             # find local minima in the 40-pixel window
-            min_val = min(line[mins[np.logical_and(mins > i-20, mins < i+20)]])
+            min_val = line[mins[mins_lo]]
+            for j in range(mins_lo + 1, mins_hi):
+                min_val = min(min_val, line[mins[j]])
             # perform CTR calculation
-            result = (max_peak - min_val)/(max_peak + min_val - 2*background)
-            # CTR cannot be > 100%, if it is, record 0 (no data)
-            if result > 1.0:
-                ctr = np.append(ctr, 0.0)
+            # if peak and minimum don't sit above background, record 0 (no data)
+            denom = max_peak + min_val - 2*background
+            if denom <= 0:
+                result = np.inf
             else:
-                ctr = np.append(ctr, result)
-                non_zero.append(i)
-        if not len(non_zero):
-            non_zero.append(None)
-    # return image CTR with left and right limits of data
-    return (np.array([ctr]), non_zero[0], non_zero[-1])
+                result = (max_peak - min_val)/denom
+            # CTR cannot be > 100%, if it is, record 0 (no data)
+            if result <= 1.0:
+                ctr[k] = result
+                if first_window:
+                    left = i
+                right = i
+        # the left limit is only kept if the first window with peaks has data
+        first_window = False
+    # return left and right limits of data
+    return left, right
+
+
+# determine CTR for every swath lineout of an image in parallel
+@njit(cache=True, parallel=True, nogil=True)
+def get_image_ctr(swaths, background, stdev):
+    # initialize image CTR with one row per swath
+    image_ctr = np.empty((len(swaths), swaths.shape[1]-40), dtype=np.float32)
+    # left and right limits of data for each swath
+    left = np.empty(len(swaths), dtype=np.int64)
+    right = np.empty(len(swaths), dtype=np.int64)
+    for i in prange(len(swaths)):
+        # find peaks and local minima in the swath lineout
+        peaks = find_wide_peaks(swaths[i], 3.0, -np.inf)
+        mins = find_minima(swaths[i])
+        # get CTR across swath directly into its row of the image CTR
+        left[i], right[i] = get_ctr(swaths[i], peaks, mins,
+                                    background, stdev, image_ctr[i])
+    return image_ctr, left, right
+
+
+# find approximate mode and standard deviation of image data in one pass
+# the mode is the upper edge of the most populated histogram bin
+# (as np.histogram would bin it) and the variance is accumulated with
+# Welford's method
+@njit(cache=True, nogil=True)
+def image_stats(img, bins):
+    hist = np.zeros(len(bins) - 1, dtype=np.int64)
+    norm = (len(bins) - 1) / (bins[-1] - bins[0])
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+    for i in range(img.shape[0]):
+        for j in range(img.shape[1]):
+            x = float(img[i, j])
+            # add to histogram, ignoring values outside the bins
+            if bins[0] <= x <= bins[-1]:
+                k = min(int((x - bins[0]) * norm), len(hist) - 1)
+                # correct for rounding at the bin edges
+                if x < bins[k]:
+                    k -= 1
+                elif x >= bins[k+1] and k != len(hist) - 1:
+                    k += 1
+                hist[k] += 1
+            # update running mean and sum of squared deviations
+            n += 1
+            delta = x - mean
+            mean += delta / n
+            m2 += delta * (x - mean)
+    return bins[np.argmax(hist) + 1], np.sqrt(m2 / n)
 
 
 # import image data
 fimg = Image.open(filename)
 img = np.array(fimg)
+# convert once to contiguous float32 for all lineout calculations
+img = np.ascontiguousarray(img, dtype=np.float32)
 
 # determine correct orientation for image
 
@@ -83,49 +154,34 @@ img = np.array(fimg)
 midpoint = len(img) // 2
 sample = np.mean(img[midpoint - 10:midpoint + 10], axis=0)
 # find peaks in the sample
-peaks, _ = find_peaks(sample, width=3)
+peaks = find_wide_peaks(sample, 3.0, -np.inf)
 
 # if the image doesn't fit the evaluation criteria, rotate and try again
 if len(peaks) < minpeaks:
-    img = np.rot90(img, axes=(1,0))
+    img = np.ascontiguousarray(np.rot90(img, axes=(1,0)))
     midpoint = len(img) // 2
     sample = np.mean(img[midpoint - 10:midpoint + 10], axis=0)
-    peaks, _ = find_peaks(sample, width=3)
+    peaks = find_wide_peaks(sample, 3.0, -np.inf)
     if len(peaks) < minpeaks:
         # if criteria still not met, raise an exception
         raise ValueError("Image cannot be evaluated. Please choose another image.")
 
 # find background counts (approximate mode of image data)
-bins = np.linspace(0,65000, 101)
-bin_indices = np.digitize(img.reshape(len(img)*len(img[0])), bins)
-background = bins[stats.mode(bin_indices)[0]]
-# find standard deviation of image data
-stdev = np.std(img.reshape(len(img)*len(img[0])))
-
-# initialize image CTR with first line
-swath = np.mean(img[:swath_size], axis=0)
-image_ctr, l, r = get_ctr(swath)
-# keep track of left and right limits of data for each swath
-left_limit = []
-right_limit = []
+# and standard deviation of image data in a single pass
+bins = np.linspace(0, 65000, 101)
+background, stdev = image_stats(img, bins)
+
+# compute every swath lineout at once from a running sum of the rows
+cum = np.concatenate([np.zeros((1, img.shape[1])),
+                      img.cumsum(axis=0, dtype=np.float64)])
+swaths = (cum[swath_size:] - cum[:-swath_size]) * (1.0/swath_size)
 
 # calculate CTR for each swath
-for i in range(len(img) - swath_size):
-    # get swath lineout
-    swath = np.mean(img[i:i+swath_size], axis=0)
-    # get CTR across swath
-    line_ctr, l, r = get_ctr(swath)
-    # add to CTR of whole image
-    image_ctr = np.append(image_ctr, line_ctr, axis=0)
-    # add left and right limits
-    if l:
-        left_limit.append(l)
-    if r:
-        right_limit.append(r)
+image_ctr, left_limit, right_limit = get_image_ctr(swaths, background, stdev)
 
 # calculate average of left and right limits for the image
-left_limit = np.mean(np.array(left_limit)) + left_offset
-right_limit = np.mean(np.array(right_limit)) + right_offset
+left_limit = np.mean(left_limit[left_limit != -1]) + left_offset
+right_limit = np.mean(right_limit[right_limit != -1]) + right_offset
 
 # show parameters
 print("Left limit:", left_limit)
@@ -133,11 +189,7 @@ print("Right limit:", right_limit)
 print("Background counts:", background)
 
 # retrieve points of interest
-y = np.array([len(img) // 4]*3)
-for _ in range(3):
-    y = np.append(y, [len(img) // 2])
-for _ in range(3):
-    y = np.append(y, [len(img)*3 // 4])
+y = np.repeat([len(img) // 4, len(img) // 2, len(img)*3 // 4], 3)
 x = np.array([int((3*left_limit + right_limit) // 4),
      int((left_limit + right_limit) // 2),
      int((left_limit + 3*right_limit) // 4)] * 3)
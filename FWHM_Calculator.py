@@ -16,11 +16,12 @@ Extra features:
 '''
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import matplotlib.pyplot as plt
 from PIL import Image
-from scipy.optimize import curve_fit
-from scipy.signal import find_peaks
-from scipy import stats
+from numba import njit, prange
+
+from kernels import find_wide_peaks
 
 
 # ============User-defined parameters====================
@@ -28,6 +29,8 @@ from scipy import stats
 filename = 'TIF/75ms_Exp.TIF'
 # define minimum intensity below which fwhm of peaks are not counted
 cutoff = 2000
+# define number of Levenberg-Marquardt iterations for each gaussian fit
+iterations = 5
 # define swath offsets
 all_offset = 0
 one_fourth_offset = 0
@@ -36,110 +39,252 @@ three_fourths_offset = 0
 # =======================================================
 
 
-# Define the Gaussian function
-def gaussian(x, amplitude, mean, stddev):
-    return amplitude * np.exp(-((x - mean) / stddev)**2 / 2)
+# solve a 3x3 linear system with Cramer's rule
+# returns the solution and False instead if the matrix is singular
+@njit(cache=True)
+def solve_3x3(m, v):
+    det = (m[0, 0] * (m[1, 1] * m[2, 2] - m[1, 2] * m[2, 1])
+           - m[0, 1] * (m[1, 0] * m[2, 2] - m[1, 2] * m[2, 0])
+           + m[0, 2] * (m[1, 0] * m[2, 1] - m[1, 1] * m[2, 0]))
+    x = np.zeros(3)
+    if det == 0 or not np.isfinite(det):
+        return x, False
+    for k in range(3):
+        mk = m.copy()
+        mk[:, k] = v
+        x[k] = (mk[0, 0] * (mk[1, 1] * mk[2, 2] - mk[1, 2] * mk[2, 1])
+                - mk[0, 1] * (mk[1, 0] * mk[2, 2] - mk[1, 2] * mk[2, 0])
+                + mk[0, 2] * (mk[1, 0] * mk[2, 1] - mk[1, 1] * mk[2, 0])) / det
+    return x, True
+
+
+# estimate gaussian parameters from the top of a peak
+# uses a weighted least-squares parabola through ln(y) above half maximum
+# returns a stddev of 0 if the peak does not curve downwards like a gaussian
+# or the estimate does not fit the samples it was made from
+@njit(cache=True)
+def estimate_gaussian(x_data, y_data, peak):
+    # find the samples above half maximum around the peak
+    half = y_data[peak] / 2
+    lo = peak
+    while lo > 0 and y_data[lo-1] > half:
+        lo -= 1
+    hi = peak
+    while hi < len(y_data) - 1 and y_data[hi+1] > half:
+        hi += 1
+    if hi - lo < 3:
+        return 0.0, 0.0, 0.0
+
+    # build normal equations for ln(y) = a + b*u + c*u^2, weighted by y^2
+    lhs = np.zeros((3, 3))
+    rhs = np.zeros(3)
+    for j in range(lo, hi + 1):
+        u = x_data[j] - x_data[peak]
+        y = float(y_data[j])
+        w = y * y
+        ly = np.log(y)
+        lhs[0, 0] += w
+        lhs[0, 1] += w * u
+        lhs[0, 2] += w * u * u
+        lhs[1, 2] += w * u * u * u
+        lhs[2, 2] += w * u * u * u * u
+        rhs[0] += w * ly
+        rhs[1] += w * u * ly
+        rhs[2] += w * u * u * ly
+    lhs[1, 0] = lhs[0, 1]
+    lhs[1, 1] = lhs[0, 2]
+    lhs[2, 0] = lhs[0, 2]
+    lhs[2, 1] = lhs[1, 2]
+    coef, solved = solve_3x3(lhs, rhs)
+    a, b, c = coef
+    if not solved or not np.isfinite(c) or c >= 0:
+        return 0.0, 0.0, 0.0
+    # convert the parabola to amplitude, mean, and stddev
+    mean = x_data[peak] - b / (2 * c)
+    stddev = 1 / np.sqrt(-2 * c)
+    # a gaussian's half-max width is about 2.355 stddev, so reject estimates
+    # centred outside the samples used or far wider or narrower than them
+    span = x_data[hi] - x_data[lo]
+    if not (x_data[lo] <= mean <= x_data[hi] and span / 8 <= stddev <= span):
+        return 0.0, 0.0, 0.0
+    return np.exp(a - b * b / (4 * c)), mean, stddev
+
+
+# accumulate J^T J and J^T r of a gaussian's residuals in a single pass
+# returns the sum of squared residuals
+@njit(cache=True)
+def gaussian_normal_equations(x_data, y_data, p, jtj, jtr):
+    jtj[:] = 0.0
+    jtr[:] = 0.0
+    sq_res = 0.0
+    for j in range(len(x_data)):
+        z = (x_data[j] - p[1]) / p[2]
+        e = np.exp(-z * z / 2)
+        r = y_data[j] - p[0] * e
+        # partial derivatives of the gaussian
+        d0 = e
+        d1 = p[0] * e * z / p[2]
+        d2 = d1 * z
+        jtj[0, 0] += d0 * d0
+        jtj[0, 1] += d0 * d1
+        jtj[0, 2] += d0 * d2
+        jtj[1, 1] += d1 * d1
+        jtj[1, 2] += d1 * d2
+        jtj[2, 2] += d2 * d2
+        jtr[0] += d0 * r
+        jtr[1] += d1 * r
+        jtr[2] += d2 * r
+        sq_res += r * r
+    jtj[1, 0] = jtj[0, 1]
+    jtj[2, 0] = jtj[0, 2]
+    jtj[2, 1] = jtj[1, 2]
+    return sq_res
+
+
+# fit a gaussian to a line of data with Levenberg-Marquardt iterations
+# returns the optimized amplitude, mean, and stddev, and the mean
+# standard error of the mean and stddev (as curve_fit's covariance gives);
+# the error is infinite if the fit breaks down
+@njit(cache=True)
+def fit_gaussian(x_data, y_data, amplitude, mean, stddev, iterations):
+    p = np.array([amplitude, mean, stddev])
+    jtj = np.zeros((3, 3))
+    jtr = np.zeros(3)
+    trial_jtj = np.zeros((3, 3))
+    trial_jtr = np.zeros(3)
+    sq_res = gaussian_normal_equations(x_data, y_data, p, jtj, jtr)
+    # damping starts small, so well-behaved rows take Gauss-Newton steps
+    damping = 1e-3
+    for it in range(iterations):
+        damped = jtj.copy()
+        for k in range(3):
+            damped[k, k] += damping * jtj[k, k]
+        step, solved = solve_3x3(damped, jtr)
+        if not solved:
+            return p[0], p[1], abs(p[2]), np.inf
+        trial = p + step
+        # only accept steps that keep a width and reduce the residuals
+        if trial[2] != 0 and np.isfinite(trial).all():
+            trial_res = gaussian_normal_equations(x_data, y_data, trial,
+                                                  trial_jtj, trial_jtr)
+            if trial_res < sq_res:
+                p = trial
+                jtj[:] = trial_jtj
+                jtr[:] = trial_jtr
+                sq_res = trial_res
+                damping /= 10
+                continue
+        damping *= 10
+
+    # parameter covariance is the inverse of J^T J scaled by residual variance
+    scale = sq_res / (len(x_data) - 3)
+    eye = np.eye(3)
+    inv_mean, solved_mean = solve_3x3(jtj, eye[1])
+    inv_std, solved_std = solve_3x3(jtj, eye[2])
+    if not (solved_mean and solved_std):
+        return p[0], p[1], abs(p[2]), np.inf
+    err = (np.sqrt(inv_mean[1] * scale) + np.sqrt(inv_std[2] * scale)) / 2
+    return p[0], p[1], abs(p[2]), err
 
 
 # fit a gaussian to each line of data to calculate fwhm
-def get_fwhm(x_data, img):
-    # define list for full-width half max
-    fwhm = []
-    
-    for i in range(len(img)):
+@njit(cache=True, parallel=True)
+def fit_fwhm(x_data, img, cutoff, iterations):
+    # define array for full-width half max (NaN where no fit was made)
+    fwhm = np.full(len(img), np.nan, dtype=np.float32)
+
+    for i in prange(len(img)):
         # Retrieve the data from the image line by line
-        y_data = img[i]
+        y_data = img[i].astype(np.float64)
         # identify single peak within user-defined parameters
-        peak, _ = find_peaks(y_data, height=cutoff, width=5)
+        peak = find_wide_peaks(y_data, 5.0, cutoff)
         if len(peak) != 1:
-            fwhm.append(None)
             continue
+        peak = peak[0]
 
-        # find approximate amplitude
-        amp = y_data[peak[0]]
+        # start from the closed-form estimate, or the peak itself if that fails
+        amp, mean, stddev = estimate_gaussian(x_data, y_data, peak)
+        if stddev == 0.0:
+            amp, mean, stddev = y_data[peak], x_data[peak], 5.0
 
         # Fit the Gaussian curve to the data
-        popt, pcov = curve_fit(gaussian, x_data, y_data, p0=[amp, peak[0], 5])
+        amplitude_fit, mean_fit, stddev_fit, err = fit_gaussian(
+            x_data, y_data, amp, mean, stddev, iterations)
 
         # if error for mean and stddev parameters is too high, reject fit
-        err = sum(np.sqrt(np.diag(pcov))[1:3]) / 2
-        if err > 1:
-            fwhm.append(None)
+        if not np.isfinite(err) or err > 1:
             continue
 
-        # popt contains the optimized parameters: amplitude, mean, and stddev
-        amplitude_fit, mean_fit, stddev_fit = popt
-        # add fwhm for this row to the list
-        fwhm.append(round(2.355 * stddev_fit))
+        # add fwhm for this row to the array
+        fwhm[i] = np.round(2.355 * stddev_fit)
     return fwhm
 
 
-# calculate average fwhm at regions of interest
-def get_avg_fwhm(roi, fwhm):
-    tot = 0
-    values = 0
-    for i in range(roi - 20, roi + 20):
-        if fwhm[i]:
-            values += fwhm[i]
-            tot += 1
-    return values // tot
+# fit a gaussian to each line of data to calculate fwhm
+def get_fwhm(x_data, img):
+    return fit_fwhm(x_data, img, cutoff, iterations)
+
+
+# calculate average fwhm of the 40-pixel swath at each region of interest
+def get_avg_fwhm(rois, fwhm):
+    rois = np.asarray(rois)
+    # verify swaths are within the fwhm data
+    if (rois - 20 < 0).any() or (rois + 20 > len(fwhm)).any():
+        raise ValueError("Error: Cannot evaluate FWHM outside of boundaries.")
+    windows = sliding_window_view(fwhm, 40)
+    avgs = np.nanmean(windows[rois - 20], axis=1)
+    # verify every swath contains at least one fit
+    if np.isnan(avgs).any():
+        raise ValueError("Image cannot be evaluated. Please choose another image.")
+    return np.floor(avgs).astype(int)
 
 
 # import image data
 fimg = Image.open(filename)
 img = np.array(fimg)
-# find and subtract background counts
-background = stats.mode(img.reshape(len(img)*len(img[0])))[0]
-img -= background
+# find and subtract background counts (most common pixel value)
+values = img.ravel()
+if np.issubdtype(img.dtype, np.integer):
+    # count every value from the lowest up, which allows negative pixels
+    low = int(values.min())
+    background = low + np.bincount(values.astype(np.int64) - low).argmax()
+else:
+    levels, counts = np.unique(values, return_counts=True)
+    background = levels[counts.argmax()]
+img -= img.dtype.type(background)
 
 # set x-axis
-x = np.linspace(0, len(img[0])-1, len(img[0]))
+x = np.arange(img.shape[1], dtype=np.float32)
 
 # retrieve fwhm for every line
 fwhm = get_fwhm(x, img)
 
-# create fwhm list without None values
-fwhm_filtered = [i for i in fwhm if i is not None]
+# create fwhm array without NaN values
+fwhm_filtered = fwhm[~np.isnan(fwhm)]
 
 # check that at least half of the fwhm values exist
 if len(fwhm_filtered) < len(fwhm) / 2:
     # if not, rotate image
     img = np.rot90(img, axes=(1,0))
     # reset x-axis
-    x = np.linspace(0, len(img[0])-1, len(img[0]))
+    x = np.arange(img.shape[1], dtype=np.float32)
     # recalculate fwhm across image
     fwhm = get_fwhm(x, img)
-    # create new fwhm list without None values
-    fwhm_filtered = [i for i in fwhm if i is not None]
+    # create new fwhm array without NaN values
+    fwhm_filtered = fwhm[~np.isnan(fwhm)]
     # if image is still not acceptable, send error message
     if len(fwhm_filtered) < len(fwhm) / 2:
         raise ValueError("Image cannot be evaluated. Please choose another image.")
 
-# find start of data
-# defined by first 5 consecutive data points
+# find start and end of data
+# defined by first and last 5 consecutive data points
+valid = ~np.isnan(fwhm)
+runs = np.convolve(valid.astype(np.int8), np.ones(5, np.int8), 'valid') == 5
 start = 0
 end = 0
-count = 0
-for i in range(len(fwhm)):
-    if fwhm[i]:
-        count += 1
-    else:
-        count = 0
-    if count == 5:
-        start = i
-        break
-
-# find end of data
-# defined by last 5 consecutive data points
-count = 0
-for i in reversed(range(len(fwhm))):
-    if fwhm[i]:
-        count += 1
-    else:
-        count = 0
-    if count == 5:
-        end = i
-        break
+if runs.any():
+    start = np.argmax(runs) + 4
+    end = len(runs) - 1 - np.argmax(runs[::-1])
 
 # find 25%, 50%, and 75% swaths of the data
 one_fourth = int((3*start + end) / 4)
@@ -173,14 +318,9 @@ print("25% pixel value:", one_fourth, offsets[0])
 print("50% pixel value:", halfway, offsets[1])
 print("75% pixel value::", three_fourths, offsets[2])
 
-# calculate fwhm at 25%
-one_fourth_fwhm = get_avg_fwhm(one_fourth, fwhm)
-
-# calculate fwhm at 50%
-halfway_fwhm = get_avg_fwhm(halfway, fwhm)
-
-# calculate fwhm at 75%
-three_fourths_fwhm = get_avg_fwhm(three_fourths, fwhm)
+# calculate fwhm at 25%, 50%, and 75%
+one_fourth_fwhm, halfway_fwhm, three_fourths_fwhm = get_avg_fwhm(
+    [one_fourth, halfway, three_fourths], fwhm)
 
 # print fwhm values of interest
 print("FWHM at 25%:", one_fourth_fwhm)
@@ -0,0 +1,125 @@
+'''
+Shared Numba Kernels
+
+Nopython versions of the scipy.signal peak searches used inside the
+hot loops of the calibration tools.
+
+The kernels are compiled with cache=True, so the compiled code is saved
+to __pycache__ and reused by every tool on later runs instead of being
+recompiled each time a tool is started.
+'''
+
+import numpy as np
+from numba import njit
+
+
+# find local maxima in a lineout, taking the middle of flat peaks
+# mirrors the local maxima search of scipy.signal.find_peaks
+@njit(cache=True, nogil=True)
+def local_maxima(line):
+    n = len(line)
+    peaks = np.empty(n // 2 + 1, dtype=np.int64)
+    count = 0
+    i = 1
+    while i < n - 1:
+        if line[i-1] < line[i]:
+            i_ahead = i + 1
+            while i_ahead < n - 1 and line[i_ahead] == line[i]:
+                i_ahead += 1
+            if line[i_ahead] < line[i]:
+                peaks[count] = (i + i_ahead - 1) // 2
+                count += 1
+                i = i_ahead
+        i += 1
+    return peaks[:count]
+
+
+# find strict local minima in a lineout
+# mirrors scipy.signal.argrelmin(line)[0]
+@njit(cache=True, nogil=True)
+def find_minima(line):
+    mins = np.empty(len(line) // 2 + 1, dtype=np.int64)
+    count = 0
+    for i in range(1, len(line) - 1):
+        if line[i] < line[i-1] and line[i] < line[i+1]:
+            mins[count] = i
+            count += 1
+    return mins[:count]
+
+
+# find peaks of a minimum height, at least a minimum distance apart
+# follows scipy.signal.find_peaks(line, height=height, distance=distance),
+# keeping the highest peaks when two are too close; unlike scipy, ties
+# between equal-height peaks are broken by position (rightmost kept first)
+@njit(cache=True, nogil=True)
+def find_peaks_simple(line, height, distance):
+    peaks = local_maxima(line)
+    peaks = peaks[line[peaks] >= height]
+    count = len(peaks)
+    # starting from the highest peak, remove neighbours that are too close
+    keep = np.ones(count, dtype=np.bool_)
+    order = np.argsort(line[peaks], kind='mergesort')
+    for o in range(count - 1, -1, -1):
+        j = order[o]
+        if not keep[j]:
+            continue
+        k = j - 1
+        while k >= 0 and peaks[j] - peaks[k] < distance:
+            keep[k] = False
+            k -= 1
+        k = j + 1
+        while k < count and peaks[k] - peaks[j] < distance:
+            keep[k] = False
+            k += 1
+    return peaks[keep]
+
+
+# find peaks of a minimum height, at least min_width wide at half prominence
+# mirrors scipy.signal.find_peaks(line, height=min_height, width=min_width);
+# narrow spikes such as hot pixels are not counted
+@njit(cache=True, nogil=True)
+def find_wide_peaks(line, min_width, min_height):
+    n = len(line)
+    candidates = local_maxima(line)
+    peaks = np.empty(len(candidates), dtype=np.int64)
+    count = 0
+    for peak in candidates:
+        if line[peak] < min_height:
+            continue
+        # find lowest point on each side before reaching higher data
+        left_base = peak
+        left_min = line[peak]
+        j = peak
+        while j >= 0 and line[j] <= line[peak]:
+            if line[j] < left_min:
+                left_min = line[j]
+                left_base = j
+            j -= 1
+        right_base = peak
+        right_min = line[peak]
+        j = peak
+        while j < n and line[j] <= line[peak]:
+            if line[j] < right_min:
+                right_min = line[j]
+                right_base = j
+            j += 1
+        prominence = line[peak] - max(left_min, right_min)
+        # interpolate where the peak crosses half its prominence
+        height = line[peak] - prominence * 0.5
+        j = peak
+        while left_base < j and height < line[j]:
+            j -= 1
+        left_ip = float(j)
+        if line[j] < height:
+            left_ip += (height - line[j]) / (line[j+1] - line[j])
+        j = peak
+        while j < right_base and height < line[j]:
+            j += 1
+        right_ip = float(j)
+        if line[j] < height:
+            right_ip -= (height - line[j]) / (line[j-1] - line[j])
+        # keep the peak if it is wide enough
+        if right_ip - left_ip >= min_width:
+            peaks[count] = peak
+            count += 1
+    return peaks[:count]